@@ -6,17 +6,23 @@ Created on Wed Oct 30 19:38:45 2024
 """
 
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QWidget, QHBoxLayout
-from PyQt5.QtCore import Qt
+from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QPushButton, QButtonGroup, QVBoxLayout, QWidget, QHBoxLayout
+from PySide6.QtCore import Qt
+import PySide6.QtAsyncio as QtAsyncio
 import asyncio
-from qasync import QEventLoop, asyncSlot
+import traceback
 import main1
 
+LOAD_DEBOUNCE_S = 0.05  # Clicks within this window collapse into one load update
 
 class ArmControlGUI(QMainWindow):
     def __init__(self, arm):
         super().__init__()
         self.arm = arm
+
+        # One long-running task applies load changes queued by the buttons
+        self._load_q = asyncio.Queue()
+        self._load_consumer = asyncio.ensure_future(self._consume_loads())
         self.initUI()
 
     def initUI(self):
@@ -38,23 +44,45 @@ class ArmControlGUI(QMainWindow):
         # Buttons for setting different load values
         button_layout = QHBoxLayout()
 
-        # Define load values and create buttons for each
-        load_values = [0.2, 1.0, 2.0, 3.0, 4.0, 5.0]  #loads in kg
-        for load in load_values:
+        # Define load values and create buttons for each, identified by their index
+        self.load_values = [0.2, 1.0, 2.0, 3.0, 4.0, 5.0]  #loads in kg
+        self.load_buttons = QButtonGroup(self)
+        for i, load in enumerate(self.load_values):
             button = QPushButton(f"{load} kg", self)
-            button.clicked.connect(lambda _, l=load: self.set_load(l))
+            self.load_buttons.addButton(button, i)
             button_layout.addWidget(button)
+        self.load_buttons.idClicked.connect(lambda i: self.set_load(self.load_values[i]))
 
         layout.addLayout(button_layout)
 
-    @asyncSlot()  # Marks this function as an asynchronous slot compatible with PyQt
-    async def set_load(self, load_value):
-        # Set the load in the arm asynchronously and update the label
-        await self.arm.set_end_mass(load_value)  # Await if this is an async call
-        self.load_label.setText(f"Current Load: {load_value:.1f} kg")
-        print(f"Updated load to: {load_value:.1f} kg")
-
-async def main():
+    def set_load(self, load_value):
+        # Queue the load for the consumer task
+        self._load_q.put_nowait(load_value)
+
+    async def _consume_loads(self):
+        while True:
+            load_value = await self._load_q.get()
+
+            # Let a burst of clicks settle, then apply only the latest load
+            await asyncio.sleep(LOAD_DEBOUNCE_S)
+            while not self._load_q.empty():
+                load_value = self._load_q.get_nowait()
+
+            # Set the load in the arm and update the label. A failed update is
+            # reported but must not end the task, or later clicks would queue
+            # forever with nothing applying them.
+            try:
+                self.arm.set_end_mass(load_value)
+                self.load_label.setText(f"Current Load: {load_value:.1f} kg")
+                print(f"Updated load to: {load_value:.1f} kg")
+            except Exception:
+                print(f"Failed to update load to: {load_value:.1f} kg")
+                traceback.print_exc()
+
+async def main(arm):
+    # Set up the GUI here so its load consumer task runs on Qt's event loop
+    arm_control = ArmControlGUI(arm)
+    arm_control.show()
    
     while True:
         print("Running background task...")
@@ -70,16 +98,7 @@ if __name__ == "__main__":
     l2 = 0.5
     initial_end_mass = 0.5 # Initial end mass / load setting
 
-    arm = main1.arm(m1,l1,m2,l2,initial_end_mass) 
-    
-    # Set up the GUI
-    arm_control = ArmControlGUI(arm)
-    arm_control.show()
-
-    # Use QEventLoop to integrate asyncio with the PyQt event loop
-    loop = QEventLoop(app)
-    asyncio.set_event_loop(loop)
+    arm = main1.Arm(m1, m2, l1, l2, initial_end_mass)
 
-    with loop:
-        loop.create_task(main())  # Start the background async task
-        loop.run_forever()        # Start the event loop
+    # Run asyncio on Qt's own event loop and start the GUI and background task
+    QtAsyncio.run(main(arm), keep_running=True)
@@ -24,9 +24,18 @@ import asyncio
 import math
 import moteus
 import moteus_pi3hat
+import sys
 import time
 import random
 
+async def stdout_writer(queue):
+    # Status lines are written from a worker thread, so a slow or
+    # blocked stdout never stalls the control loop that queued them.
+    loop = asyncio.get_running_loop()
+    while True:
+        msg = await queue.get()
+        await loop.run_in_executor(None, sys.stdout.write, msg)
+
 async def main():
     # We will be assuming a system where there are 4 servos, each
     # attached to a separate pi3hat bus.  The servo_bus_map argument
@@ -52,65 +61,87 @@ async def main():
     # that any had a fault.
     await transport.cycle([x.make_stop() for x in servos.values()])
 
-    while True:
-        # The 'cycle' method accepts a list of commands, each of which
-        # is created by calling one of the `make_foo` methods on
-        # Controller.  The most common thing will be the
-        # `make_position` method.
-
-        now = time.time()
-
-        # For now, we will just construct a position command for each
-        # of the 4 servos, each of which consists of a sinusoidal
-        # velocity command starting from wherever the servo was at to
-        # begin with.
-        #
-        # 'make_position' accepts optional keyword arguments that
-        # correspond to each of the available position mode registers
-        # in the moteus reference manual.
-        commands = [
-            servos[1].make_position(
-                position=math.nan,
-                velocity=0.1*math.sin(now),
-                query=True),
-        ]
-
-        # By sending all commands to the transport in one go, the
-        # pi3hat can send out commands and retrieve responses
-        # simultaneously from all ports.  It can also pipeline
-        # commands and responses for multiple servos on the same bus.
-        results = await transport.cycle(commands)
-
-        # The result is a list of 'moteus.Result' types, each of which
-        # identifies the servo it came from, and has a 'values' field
-        # that allows access to individual register results.
-        #
-        # The 'cycle' method accepts a list of commands, each of which
-        # is created by calling one of the `make_foo` methods on
-        # Controller.  The most common thing will be the
-        # `make_position` method.
-
-        now = time.time()
-
-        # For now, we will just construct a position command for each
-        # of the 4 servos, each of which consists of a sinusoidal
-        # velocity command starting from wherever the servo was at to
-        # begin with.
-        # Note: It is possible to not receive responses from all
-        # servos for which a query was requested.
-        #
-        # Here, we'll just print the ID, position, and velocity of
-        # each servo for which a reply was returned.
-        print(", ".join(
-            f"({result.arbitration_id} " +
-            f"{result.values[moteus.Register.POSITION]} " +
-            f"{result.values[moteus.Register.VELOCITY]})"
-            for result in results))
-
-        # We will wait 20ms between cycles.  By default, each servo
-        # has a watchdog timeout, where if no CAN command is received
-        # for 100ms the controller will enter a latched fault state.
-        await asyncio.sleep(0.02)
+    # Printing goes through a bounded queue drained by a background
+    # task, which is cancelled when the loop exits.
+    status_queue = asyncio.Queue(maxsize=64)
+    status_task = asyncio.create_task(stdout_writer(status_queue))
+
+    # The status line format and register keys are looked up once
+    # here instead of on every result of every tick.
+    status_fmt = "({} {} {})"
+    POSITION = moteus.Register.POSITION
+    VELOCITY = moteus.Register.VELOCITY
+
+    # The sinusoid runs off a monotonic clock, so NTP adjustments to the
+    # wall clock cannot make the commanded velocity jump.
+    t0 = time.perf_counter()
+
+    try:
+        while True:
+            # The 'cycle' method accepts a list of commands, each of which
+            # is created by calling one of the `make_foo` methods on
+            # Controller.  The most common thing will be the
+            # `make_position` method.
+
+            now = time.perf_counter() - t0
+
+            # For now, we will just construct a position command for each
+            # of the 4 servos, each of which consists of a sinusoidal
+            # velocity command starting from wherever the servo was at to
+            # begin with.
+            #
+            # 'make_position' accepts optional keyword arguments that
+            # correspond to each of the available position mode registers
+            # in the moteus reference manual.
+            commands = [
+                servos[1].make_position(
+                    position=math.nan,
+                    velocity=0.1*math.sin(now),
+                    query=True),
+            ]
+
+            # By sending all commands to the transport in one go, the
+            # pi3hat can send out commands and retrieve responses
+            # simultaneously from all ports.  It can also pipeline
+            # commands and responses for multiple servos on the same bus.
+            results = await transport.cycle(commands)
+
+            # The result is a list of 'moteus.Result' types, each of which
+            # identifies the servo it came from, and has a 'values' field
+            # that allows access to individual register results.
+            #
+            # The 'cycle' method accepts a list of commands, each of which
+            # is created by calling one of the `make_foo` methods on
+            # Controller.  The most common thing will be the
+            # `make_position` method.
+
+            now = time.perf_counter() - t0
+
+            # For now, we will just construct a position command for each
+            # of the 4 servos, each of which consists of a sinusoidal
+            # velocity command starting from wherever the servo was at to
+            # begin with.
+            # Note: It is possible to not receive responses from all
+            # servos for which a query was requested.
+            #
+            # Here, we'll just print the ID, position, and velocity of
+            # each servo for which a reply was returned.  If the writer
+            # has fallen behind, the line is dropped rather than waited on.
+            try:
+                status_queue.put_nowait(", ".join(
+                    status_fmt.format(result.arbitration_id,
+                                      result.values[POSITION],
+                                      result.values[VELOCITY])
+                    for result in results) + "\n")
+            except asyncio.QueueFull:
+                pass
+
+            # We will wait 20ms between cycles.  By default, each servo
+            # has a watchdog timeout, where if no CAN command is received
+            # for 100ms the controller will enter a latched fault state.
+            await asyncio.sleep(0.02)
+    finally:
+        status_task.cancel()
 
 
 if __name__ == '__main__':
@@ -5,13 +5,125 @@ bandwidth.
 """
 
 import asyncio
+import functools
 import math
 import moteus
 import moteus_pi3hat
 import time
+import weakref
 
+import jax
+import jax.numpy as jnp
+from jax.experimental import enable_x64
 import numpy as np
 import pydrake.all as drake
+from numba import njit
+
+GRAVITY = 9.81  # m/s^2
+
+@njit(cache=True, fastmath=True)
+def _id_kernel(q0, q1, v0, v1, vd0, vd1, params):
+    """Closed-form inverse dynamics of the planar 2-link arm.
+
+    Evaluates tau = M(q)vd + C(q, v)v + G(q), with q = 0 pointing both
+    links along +x. params holds the coefficients (a1, a2, a3, g1, g2).
+    """
+    a1 = params[0]
+    a2 = params[1]
+    a3 = params[2]
+    g1 = params[3]
+    g2 = params[4]
+    c2 = math.cos(q1)
+    h = -a3 * math.sin(q1)
+
+    # Mass matrix
+    m11 = a1 + a2 + 2*a3*c2
+    m12 = a2 + a3*c2
+    m22 = a2
+
+    # Gravity
+    g12 = g2 * math.cos(q0 + q1)
+    G1 = g1 * math.cos(q0) + g12
+
+    tau1 = m11*vd0 + m12*vd1 + h*(2*v0*v1 + v1**2) + G1
+    tau2 = m12*vd0 + m22*vd1 - h*v0**2 + g12
+    return tau1, tau2
+
+def _id_scalar(q, v, vd, params):
+    """JAX version of _id_kernel for a single (q, v, vd) sample."""
+    a1, a2, a3, g1, g2 = params
+    c2 = jnp.cos(q[1])
+    h = -a3 * jnp.sin(q[1])
+
+    # Mass matrix
+    m11 = a1 + a2 + 2*a3*c2
+    m12 = a2 + a3*c2
+    m22 = a2
+
+    # Gravity
+    g12 = g2 * jnp.cos(q[0] + q[1])
+    G1 = g1 * jnp.cos(q[0]) + g12
+
+    tau1 = m11*vd[0] + m12*vd[1] + h*(2*v[0]*v[1] + v[1]**2) + G1
+    tau2 = m12*vd[0] + m22*vd[1] - h*v[0]**2 + g12
+    return jnp.stack([tau1, tau2])
+
+def _link1_inertia(m1, l1):
+    """Link1's rotational inertia about its centre of mass (uniform rod)."""
+    return m1*l1**2/12
+
+@functools.lru_cache(maxsize=8)
+def _build_plant(m1, l1):
+    """Build and finalize the arm's MultibodyPlant.
+
+    Plants are cached and shared between Arm instances, which only ever
+    change state through their own contexts. Link2's inertia depends on the
+    end mass and is set per context, so only link1's parameters shape the plant.
+    """
+    plant = drake.multibody.plant.MultibodyPlant(time_step=0.0)
+    I1 = _link1_inertia(m1, l1)
+
+    # Create links
+    link1 = plant.AddRigidBody(
+        "link1",
+        drake.SpatialInertia.MakeFromCentralInertia(
+            mass=m1,
+            p_PScm_E=np.array([l1/2, 0, 0]),
+            I_SScm_E=drake.RotationalInertia(I1, I1, I1)
+        )
+    )
+    
+    # For link2, the spatial inertia is a context parameter updated with the
+    # end mass (assistance from exoskeleton)
+    link2 = plant.AddRigidBody("link2", drake.SpatialInertia())
+    
+    # Add joints (the elbow sits at the far end of link1)
+    plant.AddRevoluteJoint(
+        "shoulder",
+        plant.world_frame(),
+        link1.body_frame(),
+        [0, 0, 1]
+    )
+    elbow_frame = plant.AddFrame(
+        drake.FixedOffsetFrame(
+            "elbow_frame",
+            link1.body_frame(),
+            drake.RigidTransform([l1, 0, 0])
+        )
+    )
+    plant.AddRevoluteJoint(
+        "elbow",
+        elbow_frame,
+        link2.body_frame(),
+        [0, 0, 1]
+    )
+    
+    # Add gravity
+    plant.mutable_gravity_field().set_gravity_vector([0, -GRAVITY, 0])
+    
+    # Finalize the plant
+    plant.Finalize()
+    return plant
 
 class Arm:
     def __init__(self, m1, m2, l1, l2, initial_end_mass):
@@ -20,80 +132,176 @@ class Arm:
         self.m2 = m2
         self.l1 = l1
         self.l2 = l2
+        self.I1 = _link1_inertia(m1, l1)
         
-        # Create the multibody plant
-        self.plant = drake.multibody.plant.MultibodyPlant(time_step=0.0)
-        
-        # Create links
-        self.link1 = self.plant.AddRigidBody(
-            "link1",
-            drake.SpatialInertia(
-                mass=m1,
-                p_PScm_E=np.array([l1/2, 0, 0]),
-                G_SP_E=drake.RotationalInertia(m1*l1**2/12, m1*l1**2/12, m1*l1**2/12)
-            )
-        )
-        
-        # For link2, use a parameter that can be updated (assistance from exoskeleton)
-        self.link2 = self.plant.AddRigidBody("link2", drake.SpatialInertia())
-        self.end_mass_param = self.plant.AddParameter(
-            drake.multibody.Parameter(1)  # 1-dimensional parameter
-        )
-        
-        # Add joints
-        self.shoulder = self.plant.AddRevoluteJoint(
-            "shoulder",
-            self.plant.world_frame(),
-            self.link1.body_frame(),
-            [0, 0, 1]
-        )
-        self.elbow = self.plant.AddRevoluteJoint(
-            "elbow",
-            self.link1.body_frame(),
-            self.link2.body_frame(),
-            [0, 0, 1]
-        )
-        
-        # Add gravity
-        self.plant.mutable_gravity_field().set_gravity_vector([0, -9.81, 0])
-        
-        # Finalize the plant
-        self.plant.Finalize()
+        # Get the (shared) multibody plant
+        self.plant = _build_plant(m1, l1)
+        self.link1 = self.plant.GetBodyByName("link1")
+        self.link2 = self.plant.GetBodyByName("link2")
+        self.shoulder = self.plant.GetJointByName("shoulder")
+        self.elbow = self.plant.GetJointByName("elbow")
         
         # Create a context for the plant
         self.context = self.plant.CreateDefaultContext()
+
+        # Scratch objects reused across calls instead of reallocated each time
+        self._forces = drake.multibody.plant.MultibodyForces(self.plant)
+        self._p_buf = np.zeros(3)
+        self._q_buf = np.zeros(self.plant.num_positions())
+        self._v_buf = np.zeros(self.plant.num_velocities())
+        self._vd_buf = np.zeros_like(self._v_buf)
+
+        # Last (q, v) written into each Drake context, so an unchanged state is
+        # not rewritten and the context's caches stay valid
+        self._written_state = weakref.WeakKeyDictionary()
+
+        # Closed-form dynamics coefficients (a1, a2, a3, g1, g2), kept in one
+        # contiguous block that is handed straight to the Numba kernel
+        self._params = np.zeros(5, dtype=np.float64)
         
         # Set the initial end mass
         self.set_end_mass(initial_end_mass)
 
+        # Pay the JIT compilation cost now rather than in the control loop
+        self.calculate_inverse_dynamics([0.0, 0.0], [0.0, 0.0], [0.0, 0.0])
+
+        # Inverse dynamics vectorized over a trajectory, e.g. for MPC horizons
+        self.id_batch = jax.jit(jax.vmap(_id_scalar, in_axes=(0, 0, 0, None)))
+
+        # Make sure the closed-form model agrees with Drake before it is used
+        self.validate_inverse_dynamics()
+
     def set_end_mass(self, end_mass):
         """Update the end mass and recalculate link2 properties."""
         total_mass2 = self.m2 + end_mass
         com2 = (self.m2 * self.l2/2 + end_mass * self.l2) / total_mass2
-        I2 = self.m2 * (self.l2/2)**2 + end_mass * self.l2**2  # Simple approximation
+        I2 = self.m2 * (self.l2/2)**2 + end_mass * self.l2**2  # Simple approximation, about the elbow
 
-        # Update the parameter value
-        self.plant.SetParameter(self.context, self.end_mass_param, [end_mass])
-        
-        # Update link2 spatial inertia
-        M2 = drake.SpatialInertia(
+        # Coefficients of the closed-form manipulator equation
+        self._params[0] = self.I1 + self.m1*self.l1**2/4 + total_mass2*self.l1**2
+        self._params[1] = I2
+        self._params[2] = total_mass2 * self.l1 * com2
+        self._params[3] = (self.m1*self.l1/2 + total_mass2*self.l1) * GRAVITY
+        self._params[4] = total_mass2 * com2 * GRAVITY
+
+        # Link2 inertia for Drake, which wants it about the centre of mass.
+        # Drake contexts are only brought up to date when the Drake path runs.
+        I2_cm = max(I2 - total_mass2 * com2**2, 0.0)
+        self._link2_inertia = (total_mass2, com2, I2_cm)
+        self.end_mass = end_mass
+
+    def _sync_end_mass(self, context):
+        """Write the current end mass into a Drake context if it is out of date."""
+        total_mass2, com2, I2_cm = self._link2_inertia
+        if self.link2.get_mass(context) == total_mass2:
+            return
+        self._p_buf[0] = com2
+        M2 = drake.SpatialInertia.MakeFromCentralInertia(
             mass=total_mass2,
-            p_PScm_E=np.array([com2, 0, 0]),
-            G_SP_E=drake.RotationalInertia(I2, I2, I2)
+            p_PScm_E=self._p_buf,
+            I_SScm_E=drake.RotationalInertia(I2_cm, I2_cm, I2_cm)
         )
-        self.plant.SetBodySpatialInertiaInBodyFrame(self.context, self.link2, M2)
+        self.link2.SetSpatialInertiaInBodyFrame(context, M2)
+
+    def make_contexts(self, N):
+        """Create one Drake context per trajectory knot point.
+
+        Keeping a context per knot lets repeated evaluations at the same
+        state hit Drake's caches instead of invalidating a shared context.
+        """
+        return [self.plant.CreateDefaultContext() for _ in range(N)]
 
     def calculate_inverse_dynamics(self, q, v, vd):
         """Calculate inverse dynamics using current end mass."""
-        # Set the state
-        self.plant.SetPositions(self.context, q)
-        self.plant.SetVelocities(self.context, v)
-        
-        # Calculate inverse dynamics
-        return self.plant.CalcInverseDynamics(
-            self.context, vd, drake.multibody.plant.MultibodyForces(self.plant)
+        return _id_kernel(
+            q[0], q[1], v[0], v[1], vd[0], vd[1], self._params
         )
 
+    def inverse_dynamics_batch(self, Q, V, VD):
+        """Calculate inverse dynamics for (N, 2) arrays of states, returning (N, 2) torques."""
+        # JAX computes in float32 unless x64 is enabled, which would make the
+        # batch path disagree with the float64 Numba kernel. Enable it for this
+        # call only rather than for every JAX user in the process. The
+        # coefficients are copied because set_end_mass edits them in place,
+        # while JAX may share a numpy argument's memory and run asynchronously.
+        with enable_x64():
+            return self.id_batch(
+                jnp.asarray(Q, dtype=jnp.float64),
+                jnp.asarray(V, dtype=jnp.float64),
+                jnp.asarray(VD, dtype=jnp.float64),
+                jnp.asarray(self._params.copy(), dtype=jnp.float64),
+            )
+
+    def calculate_inverse_dynamics_drake(self, q, v, vd, context=None):
+        """Calculate inverse dynamics with Drake, for checking the closed form.
+
+        Pass a context from make_contexts to evaluate a trajectory knot point
+        without disturbing the arm's own context. The state of a context is
+        only rewritten when it changes, so it must not be set by other means.
+        """
+        if context is None:
+            context = self.context
+        self._sync_end_mass(context)
+
+        # Copy the inputs into float64 buffers so Drake gets arrays of the exact
+        # type it expects, whatever the caller passed
+        np.copyto(self._q_buf, q)
+        np.copyto(self._v_buf, v)
+        np.copyto(self._vd_buf, vd)
+
+        # Set the state, leaving it untouched (and Drake's caches valid) if unchanged
+        written = self._written_state.get(context)
+        if written is None:
+            # NaN never compares equal, so the first call always writes
+            written = (np.full_like(self._q_buf, np.nan), np.full_like(self._v_buf, np.nan))
+            self._written_state[context] = written
+        q_last, v_last = written
+        if not np.array_equal(q_last, self._q_buf):
+            self.plant.SetPositions(context, self._q_buf)
+            np.copyto(q_last, self._q_buf)
+        if not np.array_equal(v_last, self._v_buf):
+            self.plant.SetVelocities(context, self._v_buf)
+            np.copyto(v_last, self._v_buf)
+        
+        # Calculate inverse dynamics with no applied forces
+        self._forces.SetZero()
+        return self.plant.CalcInverseDynamics(context, self._vd_buf, self._forces)
+
+    def validate_inverse_dynamics(self, atol=1e-6, validate_batch=False):
+        """Compare the closed-form inverse dynamics against Drake at a few states.
+
+        With validate_batch, also check inverse_dynamics_batch against the
+        closed-form kernel. This JIT-compiles the batch path, so it is left out
+        of the default startup check used by the servo loop.
+        """
+        states = [
+            ([0.0, 0.0], [0.0, 0.0], [0.0, 0.0]),
+            ([np.pi/4, np.pi/3], [0.1, 0.2], [0.05, 0.1]),
+            ([-1.0, 2.0], [-0.5, 1.5], [2.0, -1.0]),
+        ]
+        taus = []
+        for q, v, vd in states:
+            tau = self.calculate_inverse_dynamics(q, v, vd)
+            tau_drake = self.calculate_inverse_dynamics_drake(q, v, vd)
+            if not np.allclose(tau, tau_drake, atol=atol):
+                raise RuntimeError(
+                    f"Closed-form inverse dynamics {tau} disagrees with Drake "
+                    f"{tau_drake} at q={q}, v={v}, vd={vd}"
+                )
+            taus.append(tau)
+
+        if not validate_batch:
+            return
+
+        # The batch path must match the scalar kernel at the same states
+        Q, V, VD = (np.array(x, dtype=np.float64) for x in zip(*states))
+        tau_batch = np.asarray(self.inverse_dynamics_batch(Q, V, VD))
+        if not np.allclose(tau_batch, np.array(taus), rtol=1e-12, atol=1e-12):
+            raise RuntimeError(
+                f"Batch inverse dynamics {tau_batch} disagrees with the "
+                f"closed-form kernel {np.array(taus)}"
+            )
+
 async def main():
     # Define parameters for the arm
     m1 = 1.0  # mass of link 1 in kg
@@ -105,53 +313,100 @@ async def main():
     # Initialize the arm model
     arm = Arm(m1, m2, l1, l2, assistance)
 
-    # Set up the transport and servos
+    # Set up the transport and servos, listed in joint order (shoulder, elbow)
+    servo_ids = [1, 2]
     transport = moteus_pi3hat.Pi3HatRouter(
-        servo_bus_map={1: [1, 2]},
+        servo_bus_map={1: servo_ids},
     )
     servos = {
         servo_id: moteus.Controller(id=servo_id, transport=transport)
-        for servo_id in [1, 2]
+        for servo_id in servo_ids
     }
 
     # Send initial stop command to all servos
     await transport.cycle([x.make_stop() for x in servos.values()])
 
+    # The state query is identical every tick, so build it once
+    query_commands = [
+        servos[servo_id].make_position(query=True)
+        for servo_id in servo_ids
+    ]
+
+    # Joint state buffers, filled in place each tick
+    id_to_idx = {servo_id: i for i, servo_id in enumerate(servo_ids)}
+    q = np.zeros(len(servo_ids))
+    v = np.zeros(len(servo_ids))
+    vd = np.zeros(len(servo_ids))  # zero acceleration
+    replied = np.zeros(len(servo_ids), dtype=bool)
+    zero_tau = (0.0,) * len(servo_ids)
+
+    # Torque from the last tick on which every joint replied, and how many
+    # ticks in a row have been incomplete since. It is held for up to 5 ticks
+    # (100ms, the watchdog window) so one dropped reply does not cut the
+    # gravity support.
+    last_tau = None
+    stale_ticks = 0
+    max_stale_ticks = 5
+    POSITION = moteus.Register.POSITION
+    VELOCITY = moteus.Register.VELOCITY
+
+    # Cycles are scheduled against a fixed 20ms grid so time spent in the
+    # CAN cycles and dynamics does not stretch the period
+    period = 0.02
+    next_t = time.perf_counter()
+
     while True:
         # Query the current state from servos
-        commands = [
-            servos[1].make_position(query=True),
-            servos[2].make_position(query=True),
-        ]
-        results = await transport.cycle(commands)
+        results = await transport.cycle(query_commands)
 
-        # Extract positions and velocities from the results
-        q = [results[0].values[moteus.Register.POSITION],
-             results[1].values[moteus.Register.POSITION]]
-        v = [results[0].values[moteus.Register.VELOCITY],
-             results[1].values[moteus.Register.VELOCITY]]
-        vd = [0, 0]  # zero acceleration
+        # Extract positions and velocities from the results. Replies are matched
+        # by servo id since they are not guaranteed to arrive in command order.
+        # Frames the router could not match to a command come back as raw CAN
+        # frames without an id, and are skipped.
+        replied[:] = False
+        for result in results:
+            i = id_to_idx.get(getattr(result, 'id', None))
+            if i is None:
+                continue
+            q[i] = result.values[POSITION]
+            v[i] = result.values[VELOCITY]
+            replied[i] = True
 
-        # Calculate torques using inverse dynamics
-        tau = arm.calculate_inverse_dynamics(q, v, vd)
+        # Calculate torques using inverse dynamics. The joint torques are coupled,
+        # so if any joint did not reply this tick the state is incomplete and the
+        # last complete torque is held instead. No feedforward torque is sent
+        # before the first complete reply or once the held torque is too stale.
+        if replied.all():
+            tau = arm.calculate_inverse_dynamics(q, v, vd)
+            last_tau = tau
+            stale_ticks = 0
+        else:
+            stale_ticks += 1
+            if last_tau is not None and stale_ticks <= max_stale_ticks:
+                tau = last_tau
+            else:
+                tau = zero_tau
 
         # Use the calculated torques as feedforward_torque for each motor
         commands = [
-            servos[1].make_position(
-                feedforward_torque=tau[0],
-                query=True
-            ),
-            servos[2].make_position(
-                feedforward_torque=tau[1],
+            servos[servo_id].make_position(
+                feedforward_torque=joint_tau,
                 query=True
-            ),
+            )
+            for servo_id, joint_tau in zip(servo_ids, tau)
         ]
 
         # Send the commands and get responses
         await transport.cycle(commands)
 
-        # Wait 20ms between cycles to prevent watchdog timeout
-        await asyncio.sleep(0.02)
+        # Wait for the next 20ms tick to prevent watchdog timeout
+        next_t += period
+        delay = next_t - time.perf_counter()
+        if delay < 0:
+            # Overran the period; restart the grid rather than burst to catch up
+            next_t -= delay
+            delay = 0.0
+        await asyncio.sleep(delay)
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file